@@ -25,18 +25,31 @@
 #
 # For more information, please refer to <https://unlicense.org>
 
+import os
 import sys
 import re
+import threading
 import math
 import argparse
 import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
 import soundfile as sf
 from pathlib import Path
-from itertools import chain
 from dataclasses import dataclass
-from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+BIN_EDGES = np.linspace(-1, 1, 1001)
+YTICKS = np.logspace(0, 8, 9)
+
+# matplotlib is slow to import, so it is only loaded by setup_plotting once there is something to render
+plt = Figure = FigureCanvasAgg = None
+
+# numba is just as slow, so setup_scan picks the scan implementation the first time a file is decoded
+scan = None
+scan_lock = threading.Lock()
+
+figures = threading.local()
+buffers = threading.local()
 
 def regex_type(value):
     try:
@@ -44,6 +57,31 @@ def regex_type(value):
     except re.error as e:
         raise argparse.ArgumentTypeError(f"Invalid regular expression: {e}")
 
+def file_matcher(pattern):
+    # The default pattern is a plain case-insensitive suffix test, which doesn't need the regex engine
+    if pattern.pattern == r"(?i)\.flac$":
+        return is_flac
+    return pattern.search
+
+def is_flac(name):
+    return name.lower().endswith(".flac")
+
+def iter_dirs(root):
+    # DirEntry.is_dir() answers from the cached dirent type, without the extra stat rglob makes.
+    # Like rglob, symlinked directories are yielded but not descended into, which rules out cycles
+    yield root
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            stack.append(entry.path)
+                        yield Path(entry.path)
+        except OSError:
+            continue
+
 def db(value):
     return 20 * math.log10(value) if value > 0 else -math.inf
 
@@ -52,12 +90,13 @@ def main():
     parser.add_argument("input", nargs="?", default=Path.cwd(), type=Path, help="Directory or file path (default: current working directory)")
     parser.add_argument("-f", "--filename", nargs="?", type=str, default="histogram.png", help="Output image filename (default: histogram.png)")
     parser.add_argument("-r", "--recursive", action="store_true", help="Recursively process directories")
-    parser.add_argument("-c", "--concurrency", nargs="?", type=int, default=1, help="Set the maximum number of threads (default: 1)")
+    parser.add_argument("-c", "--concurrency", nargs="?", type=int, default=1, help="Set the maximum number of worker processes and threads (default: 1, or the CPU count if given without a value)")
     parser.add_argument("-s", "--size", type=float, nargs=2, default=[10.24, 6.4], help="Output image size in inches", metavar=("WIDTH", "HEIGHT"))
     parser.add_argument("--dpi", type=float, nargs="?", default=100, help="DPI for the output image (default: 100)")
     parser.add_argument("-m", "--match", type=regex_type, nargs="?", default=r"(?i)\.flac$", help="Regular expression to match files (default: \"(?i)\\.flac$\")")
     parser.add_argument("-w", "--window", action="store_true", help="Display the histogram in a window instead of saving to a file (will ignore --recursive)")
     parser.add_argument("-o", "--overwrite", action="store_true", help="Overwrite existing image files")
+    parser.add_argument("-u", "--update", action="store_true", help="Overwrite existing image files only if an audio file is newer")
     args = parser.parse_args()
 
     if not args.input.exists():
@@ -66,37 +105,40 @@ def main():
     if any(n <= 0 for n in args.size + [args.dpi]):
         raise argparse.ArgumentTypeError("Size dimensions and DPI must be real numbers > 0")
 
-    if not args.window:
-        matplotlib.use("agg")
-   
+    if args.concurrency is None:
+        args.concurrency = os.cpu_count() or 1
+
+    if args.concurrency < 1:
+        raise argparse.ArgumentTypeError("Concurrency must be an integer >= 1")
+
+    args.matcher = file_matcher(args.match)
+
     if not args.window and args.recursive and args.input.is_dir():
-        paths = chain((args.input,), args.input.rglob("*/"))
-        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
-            executor.map(lambda path : create_histogram(path, args), paths)
+        paths = iter_dirs(args.input)
+        # Rendering is mostly pure Python, so albums are spread across processes rather than threads.
+        # Each worker then decodes its album on a single thread to keep the total bounded
+        workers = min(args.concurrency, os.cpu_count() or 1)
+        args.threads = 1
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            executor.map(create_histogram, paths, repeat(args))
     else:
+        args.threads = args.concurrency
         create_histogram(args.input, args)
-    
-def create_histogram(path, args):
-    title = path.stem if path.is_file() else path.name
-    output_path = (path.parent if path.is_file() else path) / args.filename
 
-    if not args.window and not args.overwrite and output_path.exists():
+def setup_plotting(window):
+    global plt, Figure, FigureCanvasAgg
+    if Figure is not None:
         return
 
-    files = (path,) if path.is_file() else tuple(
-        file for file in path.glob("*") if file.is_file() and re.search(args.match, file.name)
-    )
-
-    if len(files) == 0:
-        return
-
-    try:
-        info = get_audio_info(files)
-    except Exception as error:
-        print(f"Failed to process {title}: {error}", file=sys.stderr)
-        return
+    import matplotlib
+    if not window:
+        matplotlib.use("agg")
+    else:
+        import matplotlib.pyplot as plt
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-    plt.rcParams.update({
+    matplotlib.rcParams.update({
         "lines.color": "white",
         "patch.edgecolor": "white",
         "text.color": "white",
@@ -111,25 +153,135 @@ def create_histogram(path, args):
         "savefig.facecolor": "black",
         "savefig.edgecolor": "black"})
 
-    fig, ax = plt.subplots(figsize=args.size)
+def create_histogram(path, args):
+    title = path.stem if path.is_file() else path.name
+    output_path = (path.parent if path.is_file() else path) / args.filename
+
+    existing = not args.window and not args.overwrite and output_path.exists()
+
+    if existing and not args.update:
+        return
+
+    if path.is_file():
+        files = (path,)
+    else:
+        with os.scandir(path) as entries:
+            files = tuple(
+                Path(entry.path) for entry in entries if args.matcher(entry.name) and entry.is_file()
+            )
+
+    if len(files) == 0:
+        return
+
+    if existing and output_path.stat().st_mtime >= max(file.stat().st_mtime for file in files):
+        return
+
+    try:
+        info = get_audio_info(files, args.threads)
+    except Exception as error:
+        print(f"Failed to process {title}: {error}", file=sys.stderr)
+        return
+
+    setup_plotting(args.window)
+    fig, ax, footer = get_figure(args)
     ax.plot(info.histogram.edges[:-1], info.histogram.bins, color="red", linewidth=1)
     ax.grid(True, which="both", linestyle="--", linewidth=0.5)
     ax.set_yscale("log")
-    ax.set_yticks(np.logspace(0, 8, 9))
+    ax.set_yticks(YTICKS)
     ax.set_ylim(ymin=1)
     ax.set_ylabel("Number of Samples")
     ax.set_xlabel("Sample Value")
     ax.set_title(title, wrap=True, pad=15)
-    fig.text(0.01, 0.01, f"Tracks: {info.tracks}, Length: {fmt_length(info.length)}", va="bottom", ha="left")
-    fig.text(0.99, 0.01, f"Peak: {info.peak:.2f} dB FS, RMS(Sine): {info.rms:.2f} dB FS", va="bottom", ha="right")
+    footer[0].set_text(f"Tracks: {info.tracks}, Length: {fmt_length(info.length)}")
+    footer[1].set_text(f"Peak: {info.peak:.2f} dB FS, RMS(Sine): {info.rms:.2f} dB FS")
 
     if args.window:
         plt.show()
+        plt.close(fig)
     else:
-        plt.savefig(output_path, dpi=args.dpi)
+        with open(output_path, "wb") as output:
+            fig.canvas.print_png(output)
         print(f"Processed: {title}")
 
-    plt.close(fig)
+def get_figure(args):
+    if args.window:
+        fig, ax = plt.subplots(figsize=args.size)
+        return fig, ax, add_footer(fig)
+
+    # Each thread keeps one figure and clears its axes between albums, as creating figures is slow.
+    # Files are rendered on a bare Agg canvas, which skips pyplot and savefig entirely
+    if hasattr(figures, "current"):
+        figures.current[1].cla()
+    else:
+        fig = Figure(figsize=args.size, dpi=args.dpi)
+        FigureCanvasAgg(fig)
+        figures.current = (fig, fig.subplots(), add_footer(fig))
+    return figures.current
+
+def add_footer(fig):
+    return (
+        fig.text(0.01, 0.01, "", va="bottom", ha="left"),
+        fig.text(0.99, 0.01, "", va="bottom", ha="right"))
+
+def scan_numpy(samples, hist_out):
+    np.clip(samples, -1, 1, out=samples)
+    lo, hi = float(np.min(samples)), float(np.max(samples))
+    # NaN propagates through min, so the samples only need filtering when the block contains one
+    if math.isnan(lo):
+        samples = samples[~np.isnan(samples)]
+        if len(samples) == 0:
+            return 0.0, 0.0, 0
+        lo, hi = float(np.min(samples)), float(np.max(samples))
+    scaled, indices = get_buffers(len(samples))
+    np.add(samples, 1.0, out=scaled)
+    np.multiply(scaled, 500.0, out=scaled)
+    np.copyto(indices, scaled, casting="unsafe")
+    np.minimum(indices, len(hist_out) - 1, out=indices)
+    hist_out += np.bincount(indices, minlength=len(hist_out))
+    peak = max(-lo, hi)
+    # Squares go into the scratch buffer so they can be summed in float64 without allocating a temporary
+    np.square(samples, out=scaled)
+    return peak, float(scaled.sum(dtype=np.float64)), len(samples)
+
+def get_buffers(size):
+    # Scratch space for binning and squaring, kept per thread and grown to the largest block seen
+    if getattr(buffers, "size", 0) < size:
+        buffers.size = size
+        buffers.scaled = np.empty(size, dtype=np.float32)
+        buffers.indices = np.empty(size, dtype=np.int32)
+    return buffers.scaled[:size], buffers.indices[:size]
+
+# Single pass over the samples, clipping as it goes. The kernel is serial because files are
+# already spread across threads, and numba's workqueue layer aborts on concurrent parallel calls.
+def scan_numba(samples, hist_out):
+    nbins = len(hist_out)
+    peak = 0.0
+    sqsum = 0.0
+    used = 0
+    for x in samples:
+        if np.isnan(x):
+            continue
+        used += 1
+        x = -1.0 if x < -1.0 else (1.0 if x > 1.0 else x)
+        peak = max(peak, abs(x))
+        sqsum += x * x
+        hist_out[min(int((x + 1.0) * 500.0), nbins - 1)] += 1
+    return peak, sqsum, used
+
+def setup_scan():
+    global scan
+    with scan_lock:
+        if scan is not None:
+            return
+
+        try:
+            import numba
+        except ImportError:
+            scan = scan_numpy
+            return
+
+        # Only reassociation is allowed, as full fastmath would let LLVM assume there are no NaNs to skip
+        scan = numba.njit(fastmath={"reassoc", "contract"}, cache=True)(scan_numba)
 
 @dataclass(frozen=True)
 class Histogram:
@@ -144,36 +296,59 @@ class AudioInfo:
     rms: float
     histogram: Histogram
 
-def get_audio_info(files):
+def process_file(file):
+    setup_scan()
+    frames = 0
+    samples = 0
+    max_peak = 0.0
+    squared_sum = 0.0
+    hist = np.zeros(len(BIN_EDGES) - 1, dtype=np.int64)
+
+    with sf.SoundFile(file) as audio:
+        # Decoding into our own buffer stops blocks() from copying every block, and lets the numpy fallback clip it in place
+        buffer = np.empty((1 << 16, audio.channels), dtype=np.float32)
+        for block in audio.blocks(out=buffer):
+            frames += len(block)
+            # NaN samples are skipped by scan, so only the ones it used count towards the RMS
+            peak, sqsum, used = scan(block.ravel(), hist)
+            samples += used
+            max_peak = max(max_peak, peak)
+            squared_sum += sqsum
+
+        length = frames / audio.samplerate
+
+    return length, max_peak, squared_sum, samples, hist
+
+def get_audio_info(files, concurrency=1):
     total_tracks = 0
     total_samples = 0
     total_length = 0.0
     max_peak = 0.0
     squared_sum = 0.0
 
-    hist_accumulator = np.zeros(1000)
-    bin_edges = np.linspace(-1, 1, len(hist_accumulator) + 1)
+    hists = []
 
-    for file in files:
-        samples, samplerate = sf.read(file)
-        total_tracks += 1
-        total_length += len(samples) / samplerate
-        samples = np.clip(samples.ravel(), -1, 1)
-        total_samples += len(samples)
-        max_peak = max(max_peak, np.max(np.abs(samples)))
-        squared_sum += np.sum(samples ** 2)
-        hist, _ = np.histogram(samples, bins=bin_edges)
-        hist_accumulator += hist
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for length, peak, sqsum, count, hist in executor.map(process_file, files):
+            total_tracks += 1
+            total_length += length
+            total_samples += count
+            max_peak = max(max_peak, peak)
+            squared_sum += sqsum
+            hists.append(hist)
 
     if total_samples == 0:
         raise RuntimeError("Decoding produced no audio to process")
 
+    # Per-file histograms are merged in one reduction rather than one add per track
+    hist_accumulator = np.add.reduce(hists)
+
     return AudioInfo(
         tracks = total_tracks,
         length = total_length,
         peak = db(max_peak),
         rms = db(math.sqrt(squared_sum / total_samples) * math.sqrt(2)),
-        histogram = Histogram(bins=hist_accumulator, edges=bin_edges)
+        histogram = Histogram(bins=hist_accumulator, edges=BIN_EDGES)
     )
 
 def fmt_length(seconds):